@@ -1,18 +1,24 @@
 #!/usr/bin/env python
 
 import base64
+import ctypes
 import fcntl
 import hashlib
 import json
 import os
+import queue
 import re
+import select
 import sqlite3
+import struct
 import subprocess as sp
 import sys
+import threading
 import time
 
-from datetime import datetime
-from typing import Any
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Optional
 import requests
 
 try:
@@ -23,6 +29,31 @@ except:
         return p.encode("utf-8")
 
 
+# the same few paths get encoded for every ffmpeg/ffprobe argv
+fsenc = lru_cache(maxsize=256)(fsenc)
+
+try:
+    import orjson
+
+    def jloads(zb: bytes) -> Any:
+        try:
+            return orjson.loads(zb)
+        except:
+            # not utf-8 clean; let the stdlib have a go with replace
+            return json.loads(zb.decode("utf-8", "replace"))
+
+    def jdumps(o: Any) -> bytes:
+        return orjson.dumps(o, option=orjson.OPT_INDENT_2)
+
+except:
+
+    def jloads(zb: bytes) -> Any:
+        return json.loads(zb.decode("utf-8", "replace"))
+
+    def jdumps(o: Any) -> bytes:
+        return json.dumps(o, indent="  ").encode("utf-8")
+
+
 _ = r"""
 for copyparty
 
@@ -30,6 +61,8 @@ deps:
   ffmpeg
   rclone
   mediainfo
+optional:
+  orjson
 debian:
   apt install rclone ffmpeg mediainfo python3 python3-requests
 
@@ -50,6 +83,49 @@ CONDITIONAL_UPLOAD = True
 DRYRUN = False
 DEBOUNCE = 2 if DRYRUN else 10
 
+_GB = None
+_VLOG = None
+_SESS = requests.Session()
+
+_RE_DATE = re.compile(r"^(....)-?(..)-?(..)")
+_RE_SUBDIR = re.compile(r"^[\w-]{11}-[0-9]{13}$")
+_RE_FNYID = re.compile(r"[\[({}]([\w-]{11})[\])}][^\]\[(){}]+$")
+_RE_IPSCRUB = re.compile(rb'(?<=[?&])ip=[0-9Aa-f%\.]+(?=[&"])')
+
+_THUMB_EXTS = frozenset("jpg jpeg webp png".split())
+_VIDEO_EXTS = frozenset("mp4 webm mkv flv".split())
+
+# stuff the webplayer needs
+_UP_EXTS = frozenset("mp4 webm mkv flv opus ogg mp3 m4a aac webp jpg png".split())
+_UP_JSON = (".chat.json", ".info.json")
+
+_FFMPEG = tuple(b"ffmpeg -y -hide_banner -nostdin -v warning -i".split())
+_FFPROBE = tuple(
+    b"ffprobe -hide_banner -v warning -show_streams -show_format -of json".split()
+)
+_FFDUMP = tuple(b"ffmpeg -hide_banner -nostdin -v warning".split())
+_FFDUMP_OUT = tuple(b"-c copy -t 1 -f null -".split())
+# mp4 and webm both reject attachments, so always drop them
+_REMUX = tuple(b"-map 0 -map -0:t -c copy -movflags +faststart".split())
+_FASTSTART = (b"-movflags", b"+faststart")
+_SPLIT_V = tuple(b"-map 0:V:0 -map -0:t -c copy".split())
+_SPLIT_A = tuple(b"-map 0:a:0 -map -0:t -c copy".split())
+_THUMBEX = tuple(b"-map 0:v -map -0:V -c copy -frames:v 1 -f image2 -update 1".split())
+_THUMBGEN = tuple(
+    b"-map 0:V:0 -vf scale=512:288:force_original_aspect_ratio=decrease,setsar=1:1 -frames:v 1 -metadata:s:v:0 rotate=0 -q:v 8".split()
+)
+
+
+def _ext(fp: str) -> str:
+    # like fp.split(".")[-1] but without the list
+    return fp[fp.rfind(".") + 1 :]
+
+
+def _stem(fp: str) -> str:
+    # like fp.rsplit(".", 1)[0]
+    i = fp.rfind(".")
+    return fp[:i] if i >= 0 else fp
+
 
 def eprint(*a: Any, **ka: Any) -> None:
     ka["file"] = sys.stderr
@@ -58,11 +134,15 @@ def eprint(*a: Any, **ka: Any) -> None:
 
 def log(yi: str, msg: str) -> None:
     # append to logfile
-    ts = datetime.utcnow().strftime("%Y-%m%d-%H%M%S.%f")[:-3]
-    msg = f"[{yi}] [{ts}] {msg}"
+    global _VLOG
+    sec, ns = divmod(time.time_ns(), 1_000_000_000)
+    ts = time.strftime("%Y-%m%d-%H%M%S", time.gmtime(sec))
+    msg = f"[{yi}] [{ts}.{ns // 1_000_000:03d}] {msg}"
     eprint(msg)
-    with open("vlog.txt", "ab") as f:
-        f.write(msg.encode("utf-8", "replace") + b"\n")
+    if not _VLOG:
+        # unbuffered; one O_APPEND write per line
+        _VLOG = open("vlog.txt", "ab", buffering=0)
+    _VLOG.write(msg.encode("utf-8", "replace") + b"\n")
 
 
 def _wh(yi: str, md: dict[str, str], j: Any) -> None:
@@ -77,7 +157,7 @@ def _wh(yi: str, md: dict[str, str], j: Any) -> None:
     for v in j["fields"]:
         v["inline"] = True
 
-    requests.post(WEBHOOK, json={"embeds": [j]})
+    _SESS.post(WEBHOOK, json={"embeds": [j]}, timeout=10)
 
 
 def wh_ok(yi: str, md: dict[str, str]) -> None:
@@ -96,45 +176,173 @@ def wh_vidchk(yi: str, md: dict[str, str]) -> None:
     _wh(yi, md, j)
 
 
-def errchk(so: bytes, se: bytes, rc: int) -> tuple[int, str]:
+def _gb() -> sqlite3.Connection:
+    global _GB
+    if _GB is None:
+        # read-only; the guestbook itself is the only writer
+        _GB = sqlite3.connect("file:guestbook.db3?mode=ro", uri=True)
+    return _GB
+
+
+@lru_cache(maxsize=1024)
+def gb_uid(ip: str) -> Optional[str]:
+    t = "select msg from gb where ip = ? order by ts desc limit 1"
+    r = _gb().execute(t, (ip,)).fetchone()
+    return r[0] if r else None
+
+
+@lru_cache(maxsize=1)
+def load_salt() -> bytes:
+    try:
+        with open("salt", "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+
+    salt = base64.b64encode(os.urandom(32))[:24]
+    tmp = f"salt.{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(salt)
+
+    try:
+        # atomic, and fails if another rag-prep got there first
+        os.link(tmp, "salt")
+    except FileExistsError:
+        with open("salt", "rb") as f:
+            salt = f.read()
+    finally:
+        os.unlink(tmp)
+
+    return salt
+
+
+def lower_prio() -> None:
+    # renice 19
+    os.setpriority(os.PRIO_PROCESS, 0, 19)
+
+    # ionice -n 7 (best-effort class, lowest level) without spawning ionice
+    nr = {"x86_64": 251, "aarch64": 30}.get(os.uname().machine)
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if nr and libc.syscall(nr, 1, 0, (2 << 13) | 7) == 0:
+            return
+    except:
+        pass
+
+    sp.run(f"ionice -n 7 -p {os.getpid()}".split())
+
+
+def errchk(se: bytes, rc: int) -> tuple[int, str]:
+    # only the first line is reported; don't decode the rest
     if rc:
-        err = (so + se).decode("utf-8", "replace").split("\n", 1)
-        return rc, f"ERROR {rc}: {err[0]}"
+        err = se.split(b"\n", 1)[0].decode("utf-8", "replace")
+        return rc, f"ERROR {rc}: {err}"
 
     if se:
-        err = se.decode("utf-8", "replace").split("\n", 1)
-        if err:
-            return rc, f"Warning: {err[0]}"
+        err = se.split(b"\n", 1)[0].decode("utf-8", "replace")
+        return rc, f"Warning: {err}"
 
     return 0, ""
 
 
 def run(cmd: list[bytes]) -> tuple[int, str]:
-    p = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE)
-    so, se = p.communicate()
-    return errchk(so, se, p.returncode)
+    # ffmpeg and rclone only ever talk on stderr
+    p = sp.Popen(cmd, stdout=sp.DEVNULL, stderr=sp.PIPE)
+    se = p.communicate()[1]
+    return errchk(se, p.returncode)
 
 
-def getmime(fp: str) -> str:
-    zs = "file --mime-type"
-    cmd = zs.encode("ascii").split(b" ") + [fsenc(fp)]
-    so = sp.check_output(cmd)
-    return so.decode("utf-8", "replace").strip().split(" ")[-1]
+def has_partial(fdir: str) -> bool:
+    with os.scandir(fdir) as it:
+        return any(x.name.endswith(".PARTIAL") for x in it)
 
 
-def fmtconv(fpi: str, fpo: str, no_att="") -> tuple[int, str]:
-    zi, zo = [
-        x.encode("ascii").split(b" ")
-        for x in [
-            "ffmpeg -y -hide_banner -nostdin -v warning -i",
-            f"-map 0 {no_att} -c copy -movflags +faststart",
-        ]
-    ]
+def wait_idle_poll(fdir: str, t0: float) -> None:
+    while time.time() - t0 < 600:
+        busy = False
+        for _ in range(DEBOUNCE):
+            time.sleep(1)
+            if has_partial(fdir):
+                busy = True
+                break
+
+        if not busy:
+            break
+
+
+def inotify_read(fd: int, timeout: float) -> list[bytes]:
+    # filenames from the next batch of events, or nothing on timeout
+    if not select.select([fd], [], [], timeout)[0]:
+        return []
+
+    zb = os.read(fd, 65536)
+    ret = []
+    ofs = 0
+    while ofs < len(zb):
+        # struct inotify_event { int wd; u32 mask, cookie, len; char name[len]; }
+        n = struct.unpack_from("I", zb, ofs + 12)[0]
+        ret.append(zb[ofs + 16 : ofs + 16 + n].rstrip(b"\0"))
+        ofs += 16 + n
+
+    return ret
+
+
+def wait_idle(fdir: str, t0: float) -> None:
+    libc = ctypes.CDLL(None, use_errno=True)
+    fd = libc.inotify_init1(os.O_CLOEXEC)
+    if fd < 0:
+        return wait_idle_poll(fdir, t0)
+
+    try:
+        # IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        if libc.inotify_add_watch(fd, fsenc(fdir), 0x3C8) < 0:
+            return wait_idle_poll(fdir, t0)
+
+        busy = True
+        while busy and time.time() - t0 < 600:
+            busy = has_partial(fdir)
+
+            # idle when DEBOUNCE sec pass without any .PARTIAL activity
+            t1 = time.time() + DEBOUNCE
+            while True:
+                zf = t1 - time.time()
+                if zf <= 0:
+                    break
+
+                if any(x.endswith(b".PARTIAL") for x in inotify_read(fd, zf)):
+                    busy = True
+                    break
+    finally:
+        os.close(fd)
+
+
+def flock_any(fns: list[str]):
+    # block on all of them; keep the first one we get
+    q = queue.Queue()
+    mu = threading.Lock()
+    won = []
+
+    def w(fn):
+        f = open(fn, "wb")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        with mu:
+            if won:
+                # lost the race; let the next waiter have it
+                f.close()
+                return
+            won.append(f)
+        q.put(f)
 
+    for fn in fns:
+        threading.Thread(target=w, args=(fn,), daemon=True).start()
+
+    return q.get()
+
+
+def fmtconv(fpi: str, fpo: str) -> tuple[int, str]:
     a, b = os.path.split(fpo)
     tfpo = os.path.join(a, "mux-" + b)
-    cmd = zi + [fsenc(fpi)] + zo + [fsenc(tfpo)]
-
+    cmd = [*_FFMPEG, fsenc(fpi), *_REMUX, fsenc(tfpo)]
     ret = run(cmd)
     if not ret[0]:
         os.rename(tfpo, fpo)
@@ -148,51 +356,56 @@ def fmtconv(fpi: str, fpo: str, no_att="") -> tuple[int, str]:
 
 
 def fmtsplit(yi, fpi: str, fpv: str, fpa: str) -> tuple[int, str]:
-    vf = " -movflags +faststart" if fpv.endswith("mp4") else ""
-    af = " -movflags +faststart" if fpa.endswith("m4a") else ""
-    zi, zv, za = [
-        x.encode("ascii").split(b" ")
-        for x in [
-            "ffmpeg -y -hide_banner -nostdin -v warning -i",
-            "-map 0:V:0 -map -0:t -c copy" + vf,
-            "-map 0:a:0 -map -0:t -c copy" + af,
-        ]
-    ]
+    zv = _SPLIT_V + _FASTSTART if fpv.endswith("mp4") else _SPLIT_V
+    za = _SPLIT_A + _FASTSTART if fpa.endswith("m4a") else _SPLIT_A
 
-    ret = (0, "")
-    for out_args, out_fp in [(za, fpa), (zv, fpv)]:
-        cmd = zi + [fsenc(fpi)] + out_args + [fsenc(out_fp)]
-        # log(yi, str(cmd))
-        ret = run(cmd)
-        if ret[0]:
-            return ret
-
-    return ret
+    # both outputs from one demux of the input
+    cmd = [*_FFMPEG, fsenc(fpi), *za, fsenc(fpa), *zv, fsenc(fpv)]
+    # log(yi, str(cmd))
+    return run(cmd)
 
 
 def thumbex(fpi: str, fpo: str) -> tuple[int, str]:
-    zi, zo = [
-        x.encode("ascii").split(b" ")
-        for x in [
-            "ffmpeg -y -hide_banner -nostdin -v warning -i",
-            "-map 0:v -map -0:V -c copy",
-        ]
-    ]
-
-    cmd = zi + [fsenc(fpi)] + zo + [fsenc(fpo)]
+    cmd = [*_FFMPEG, fsenc(fpi), *_THUMBEX, fsenc(fpo)]
     return run(cmd)
 
 
-def thumbgen(fpi: str, fpo: str) -> tuple[int, str]:
-    zi, zo = [
-        x.encode("ascii").split(b" ")
-        for x in [
-            "ffmpeg -y -hide_banner -nostdin -v warning -i",
-            "-map 0:V -vf scale=512:288:force_original_aspect_ratio=decrease,setsar=1:1 -frames:v 1 -metadata:s:v:0 rotate=0 -q:v 8",
-        ]
-    ]
+def thumbex_any(yi: str, fpi: str) -> str:
+    # copy out the embedded art as-is, then name it by its magic
+    log(yi, "thumb-ex ...")
+    tfp = fpi + ".thumb"
+    rc, err = thumbex(fpi, tfp)
+    zb = b""
+    if not rc:
+        with open(tfp, "rb") as f:
+            zb = f.read(12)
+
+    ext = ""
+    if zb.startswith(b"\xff\xd8"):
+        ext = "jpg"
+    elif zb.startswith(b"\x89PNG"):
+        ext = "png"
+    elif zb.startswith(b"RIFF") and zb[8:] == b"WEBP":
+        ext = "webp"
+
+    if not ext:
+        if not rc:
+            rc, err = -1, f"unexpected format {zb[:4]!r}"
+        log(yi, f"thumb-ex failed; {rc}: {err}")
+        try:
+            os.unlink(tfp)
+        except:
+            pass
+        return ""
+
+    fp = f"{fpi}.{ext}"
+    os.rename(tfp, fp)
+    log(yi, f"thumb-ex {ext} OK")
+    return fp
 
-    cmd = zi + [fsenc(fpi)] + zo + [fsenc(fpo)]
+
+def thumbgen(fpi: str, fpo: str) -> tuple[int, str]:
+    cmd = [*_FFMPEG, fsenc(fpi), *_THUMBGEN, fsenc(fpo)]
     return run(cmd)
 
 
@@ -211,7 +424,7 @@ def esdoc_from_ffprobe(yi, md, mig):
 
     uploaded = md.get("date")
     if uploaded:
-        m = re.search(r"^(....)-?(..)-?(..)", str(uploaded))
+        m = _RE_DATE.search(str(uploaded))
         if m:
             md["date"] = f"{m[1]}-{m[2]}-{m[3]}"
 
@@ -233,7 +446,7 @@ def esdoc_from_ffprobe(yi, md, mig):
     return doc
 
 
-def esdoc_from_infojson(yi, md, vid_fp, ups):
+def esdoc_from_infojson(yi, md, vid_fp, ups, mig):
     log(yi, "esdoc from infojson...")
     ijfn = None
     for f in ups:
@@ -242,11 +455,12 @@ def esdoc_from_infojson(yi, md, vid_fp, ups):
 
     if ijfn:
         md["infoj"] = "provided"
+    elif mig.get("Format", "").lower() not in ["matroska", "webm"]:
+        # only matroska can carry it as an attachment; skip the ffprobe
+        return {}
     else:
-        zs = "ffprobe -hide_banner -v warning -show_streams -show_format -of json"
-        cmd = zs.encode("ascii").split(b" ") + [fsenc(vid_fp)]
-        so = sp.check_output(cmd)
-        fj = json.loads(so.decode("utf-8", "replace"))
+        so = sp.check_output([*_FFPROBE, fsenc(vid_fp)])
+        fj = jloads(so)
         p1 = None  # found by filename
         p2 = None  # found by mimetype
         # log(yi, vid_fp + "\n" + json.dumps(fj))
@@ -269,32 +483,26 @@ def esdoc_from_infojson(yi, md, vid_fp, ups):
         ijfn = f"{os.path.dirname(vid_fp)}/{yi}.info.json"
         ups.append(ijfn)
 
-        zi, zo = [
-            x.encode("ascii").split(b" ")
-            for x in [
-                f"ffmpeg -hide_banner -nostdin -v warning -dump_attachment:{n} i.json -i",
-                "-c copy -t 1 -f null -",
-            ]
-        ]
-
-        rc, err = run(zi + [fsenc(vid_fp)] + zo)
+        za = b"-dump_attachment:%d" % (n,)
+        rc, err = run([*_FFDUMP, za, b"i.json", b"-i", fsenc(vid_fp), *_FFDUMP_OUT])
         if rc:
             raise Exception(f"json extract failed: {err}")
 
         md["infoj"] = "in mkv"
 
-    with open(ijfn, "r", encoding="utf-8") as f:
+    with open(ijfn, "rb") as f:
         ijtxt = f.read()
 
-    ijtxt = re.sub(r'(?<=[?&])ip=[0-9Aa-f%\.]+(?=[&"])', "ip=2.4.3.4", ijtxt)
-
-    with open(ijfn, "w", encoding="utf-8") as f:
-        f.write(ijtxt)
+    zb = _RE_IPSCRUB.sub(b"ip=2.4.3.4", ijtxt)
+    if zb != ijtxt:
+        ijtxt = zb
+        with open(ijfn, "wb") as f:
+            f.write(ijtxt)
 
-    infojson = json.loads(ijtxt)
+    infojson = jloads(ijtxt)
 
     uploaded = str(infojson["upload_date"])
-    m = re.search(r"^(....)-?(..)-?(..)", uploaded)
+    m = _RE_DATE.search(uploaded)
     if m:
         uploaded = f"{m[1]}-{m[2]}-{m[3]}"
 
@@ -331,7 +539,7 @@ def esdoc_from_infojson(yi, md, vid_fp, ups):
 def write_esdoc(yi, vid_fp, ups, md, mig):
     # if '.info.json"' in json.dumps(mig.get("extra", {})):
     try:
-        doc = esdoc_from_infojson(yi, md, vid_fp, ups)
+        doc = esdoc_from_infojson(yi, md, vid_fp, ups, mig)
     except Exception as ex:
         doc = {}
         log(yi, f"esdoc from infojson failed: {ex}")
@@ -353,17 +561,22 @@ def write_esdoc(yi, vid_fp, ups, md, mig):
 
     rd = f"pub/esdocs/v{yi[:1]}"
     fn = f"{rd}/{yi}-{time.time():.0f}.json"
-    os.makedirs(rd, exist_ok=True)
-    with open(fn, "w", encoding="utf-8") as f:
-        json.dump(doc, f, indent="  ")
+    try:
+        f = open(fn, "wb")
+    except FileNotFoundError:
+        # only the first esdoc in each bucket
+        os.makedirs(rd, exist_ok=True)
+        f = open(fn, "wb")
+
+    with f:
+        f.write(jdumps(doc))
 
     log(yi, "esdoc ok")
 
 
 def main():
     t0 = time.time()
-    sp.run(f"renice 19 {os.getpid()}".split())
-    sp.run(f"ionice -n 7 -p {os.getpid()}".split())
+    lower_prio()
 
     vid_fp = sys.argv[1]
 
@@ -376,41 +589,26 @@ def main():
 
     # wait until folder idle
     print("rag-prep waiting for directory-idle...")
-    while time.time() - t0 < 600:
-        busy = False
-        for _ in range(DEBOUNCE):
-            time.sleep(1)
-            for f in os.listdir(fdir):
-                if f.endswith(".PARTIAL"):
-                    busy = True
-
-            if busy:
-                break
-
-        if not busy:
-            break
+    wait_idle(fdir, t0)
 
     # ensure max 2 instances running
     print("rag-prep waiting for lock...")
     locks = ["/dev/shm/rplk1", "/dev/shm/rplk2"]
-    while True:
-        for lk in locks:
-            lkf = open(lk, "wb")
-            try:
-                fcntl.flock(lkf, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                break
-            except:
-                lkf.close()
-
-        if not lkf.closed:
+    for lk in locks:
+        lkf = open(lk, "wb")
+        try:
+            fcntl.flock(lkf, fcntl.LOCK_EX | fcntl.LOCK_NB)
             break
+        except:
+            lkf.close()
 
-        time.sleep(1)
+    if lkf.closed:
+        # all taken; wake up as soon as either frees up
+        lkf = flock_any(locks)
 
     try:
         # prefer metadata from stdin
-        zs = zb.decode("utf-8", "replace")
-        md = json.loads(zs)
+        md = jloads(zb)
     except:
         # but use ffprobe if necessary
         from copyparty.mtag import ffprobe
@@ -423,24 +621,10 @@ def main():
 
     ip = md.get("up_ip")
     if ip:
-        db = sqlite3.connect("guestbook.db3")
-        t = "select msg from gb where ip = ? order by ts desc"
-        r = db.execute(t, (md["up_ip"],)).fetchone()
-        db.close()
-
-        if r:
-            uid = r[0]
-        else:
-            uid = ip
-            if os.path.exists("salt"):
-                with open("salt", "r") as f:
-                    salt = f.read()
-            else:
-                salt = base64.b64encode(os.urandom(32)).decode("ascii")[:24]
-                with open("salt", "w") as f:
-                    f.write(salt)
-            uid = ip + salt
-            buid = hashlib.sha1(uid.encode("ascii")).digest()
+        uid = gb_uid(ip)
+        if not uid:
+            zb = load_salt()
+            buid = hashlib.blake2b(ip.encode("ascii"), key=zb, digest_size=18).digest()
             uid = "ip:" + base64.b64encode(buid).decode("ascii")[:24]
 
         md["uploader"] = uid
@@ -453,7 +637,7 @@ def main():
         log(yi, f"id from comment: {vid_fp}")
 
     subdir = vid_fp.split("/")[-2]
-    if re.match(r"^[\w-]{11}-[0-9]{13}$", subdir):
+    if len(subdir) == 25 and _RE_SUBDIR.match(subdir):
         if not yi:
             yi = subdir[:11]
             log(yi, f"id from subdir: {vid_fp}")
@@ -461,7 +645,7 @@ def main():
             f.write("a")
 
     if not yi:
-        m = re.search(r"[\[({}]([\w-]{11})[\])}][^\]\[(){}]+$", vid_fp)
+        m = _RE_FNYID.search(vid_fp)
         if m:
             yi = m.group(1)
             log(yi, f"id from filename: {vid_fp}")
@@ -480,9 +664,16 @@ def main():
             return t
 
     mib = sp.check_output([b"mediainfo", b"--Output=JSON", b"--", fsenc(vid_fp)])
-    mi = json.loads(mib.decode("utf-8", "replace"))
-    mig = next(x for x in mi["media"]["track"] if x["@type"] == "General")
-    miv = next((x for x in mi["media"]["track"] if x["@type"] == "Video"), None)
+    mig = miv = None
+    for x in jloads(mib)["media"]["track"]:
+        if x["@type"] == "General":
+            mig = mig or x
+        elif x["@type"] == "Video":
+            miv = miv or x
+
+        if mig and miv:
+            break
+
     fmt = mig["Format"].lower()
     log(yi, f"format: {fmt}")
 
@@ -500,7 +691,7 @@ def main():
         ext = "flv"
 
     if ext and not vid_fp.lower().endswith("." + ext):
-        fn2 = vid_fp.rsplit(".", 1)[0] + "." + ext
+        fn2 = _stem(vid_fp) + "." + ext
         os.rename(vid_fp, fn2)
         log(yi, f"renamed {vid_fp} => {fn2}")
         vid_fp = fn2
@@ -508,33 +699,40 @@ def main():
     # upload everything with the same basename
     ups = []
     fdir, fname = os.path.split(vid_fp)
-    name = fname.rsplit(".", 1)[0] + "."
-    for fn in os.listdir(fdir):
-        if fn.startswith(name):
-            fp = os.path.join(fdir, fn)
-            log(yi, f"found {fp}")
-            ups.append(fp)
+    name = _stem(fname) + "."
+    with os.scandir(fdir) as it:
+        for de in it:
+            if de.name.startswith(name):
+                log(yi, f"found {de.path}")
+                ups.append(de.path)
+
+    have_thumb = any(_ext(x).lower() in _THUMB_EXTS for x in ups)
+
+    # look for embedded art while the remux is running
+    tpe = ThreadPoolExecutor(1)
+    tex = None if have_thumb else tpe.submit(thumbex_any, yi, vid_fp)
+
+    # thumb-gen reads the remux/split output if there is one;
+    # already indexed and without the attachments
+    thumb_src = vid_fp
 
     if need_remux:
         remux_ok = False
-        for no_att in ["", "-map -0:t"]:
-            for ext in [".mp4", ".webm"]:
-                log(yi, f"remuxing to {ext}")
-                fp2 = vid_fp + ext
-                rc, err = fmtconv(vid_fp, fp2, no_att)
-                if rc:
-                    log(yi, f"remux failed; {rc}: {err}")
-                    try:
-                        os.unlink(fp2)
-                    except:
-                        pass
-                if not rc:
-                    log(yi, f"remux success; {err}")
-                    remux_ok = True
-                    ups.append(fp2)
-                    break
-
-            if remux_ok:
+        for ext in [".mp4", ".webm"]:
+            log(yi, f"remuxing to {ext}")
+            fp2 = vid_fp + ext
+            rc, err = fmtconv(vid_fp, fp2)
+            if rc:
+                log(yi, f"remux failed; {rc}: {err}")
+                try:
+                    os.unlink(fp2)
+                except:
+                    pass
+            if not rc:
+                log(yi, f"remux success; {err}")
+                remux_ok = True
+                thumb_src = fp2
+                ups.append(fp2)
                 break
 
         if not remux_ok:
@@ -553,30 +751,19 @@ def main():
                         pass
             else:
                 log(yi, "split OK")
+                thumb_src = fpv
                 ups.extend([fpv, fpa])
 
-    have_thumb = False
-    for fp in ups:
-        if fp.lower().rsplit(".")[-1] in ["jpg", "jpeg", "webp", "png"]:
-            have_thumb = True
-
-    if not have_thumb:
-        for ext in [".webp", ".png", ".jpg"]:
-            log(yi, f"thumb-ex: {ext} ...")
-            fp = vid_fp + ext
-            rc, err = thumbex(vid_fp, fp)
-            if not rc:
-                have_thumb = True
-                log(yi, "thumb-ex OK")
-                ups.append(fp)
-                break
-            else:
-                log(yi, f"thumb-ex failed; {rc}: {err}")
+    fp = tex.result() if tex else ""
+    tpe.shutdown()
+    if fp:
+        have_thumb = True
+        ups.append(fp)
 
     if not have_thumb:
         log(yi, "thumb-gen ...")
         fp = vid_fp + ".jpg"
-        rc, err = thumbgen(vid_fp, fp)
+        rc, err = thumbgen(thumb_src, fp)
         if not rc:
             ups.append(fp)
             log(yi, "thumb-gen OK")
@@ -584,17 +771,18 @@ def main():
             log(yi, f"thumbing failed; {rc}: {err}")
 
     # skip stuff that isn't needed by the webplayer
-    ptn = re.compile(
-        r"\.(mp4|webm|mkv|flv|opus|ogg|mp3|m4a|aac|webp|jpg|png|chat.json|info.json)$"
-    )
-    skips = [x for x in ups if not ptn.search(x.lower())]
-    ups = [x for x in ups if x not in skips]
-
-    # and give things better filenames
-    ups2 = []  # renamed
-    for fp in ups:
-        fn2 = os.path.basename(os.path.realpath(fp))
-
+    skips = []
+    keeps = []
+    for x in ups:
+        zs = x.lower()
+        want = _ext(zs) in _UP_EXTS or zs.endswith(_UP_JSON)
+        (keeps if want else skips).append(x)
+    ups = keeps
+
+    # and give things better filenames;
+    # everything is in fdir so do it relative to that
+    dfd = os.open(fdir, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+    for n, fp in enumerate(ups):
         ext = ""
         for t in ["chat.json", "info.json"]:
             if fp.endswith("." + t):
@@ -602,37 +790,41 @@ def main():
                 break
 
         if not ext:
-            ext = fp.split(".")[-1]
+            ext = _ext(fp)
 
         suf = ""
-        if ext in "mp4|webm|mkv|flv".split("|"):
+        if ext in _VIDEO_EXTS:
             yres = md.get("res", "").split("x")[-1]
             suf = f".{yres}.{md.get('vc')}"
 
-        fn2 = f"{yi}{suf}.{ext}"
-        ups2.append(fn2)
-        log(yi, f"post {fn2} = {fp.split('/')[-1]}")
+        fn2 = ups[n] = f"{yi}{suf}.{ext}"
+        log(yi, f"post {fn2} = {os.path.basename(fp)}")
         fp2 = os.path.join(fdir, fn2)
-        os.rename(fp, fp2)
+        os.replace(os.path.basename(fp), fn2, src_dir_fd=dfd, dst_dir_fd=dfd)
         if vid_fp == fp:
             vid_fp = fp2
-    ups = ups2
     for fn in skips:
         log(yi, f"skip {fn}")
 
     write_esdoc(yi, vid_fp, [os.path.join(fdir, x) for x in ups], md, mig)
 
     lst = os.path.join(fdir, "rclone.lst")
-    with open(lst, "w", encoding="utf-8") as f:
-        f.write("\n".join(ups) + "\n")
+    with open(lst, "wb") as f:
+        f.write(b"\n".join([fsenc(x) for x in ups]) + b"\n")
 
     dst = f"{RCLONE_REMOTE}:{yi}/".encode("utf-8")
+    zb = b"%d" % (max(1, len(ups)),)
     cmd = [
         b"rclone",
         b"copy",
-        b"--files-from",
-        lst.encode("utf-8"),
-        fdir.encode("utf-8"),
+        b"--files-from-raw",
+        fsenc(lst),
+        b"--transfers",
+        zb,
+        b"--checkers",
+        zb,
+        b"--no-traverse",
+        fsenc(fdir),
     ]
     cmd += [dst]
 
@@ -654,9 +846,11 @@ def main():
 
     t2 = time.time()
     log(yi, f"{t1 - t0:.1f} + {t2 - t1:.1f} sec")
-    for fn in ups:
-        if not DRYRUN:
-            os.unlink(fsenc(os.path.join(fdir, fn)))
+    if not DRYRUN:
+        for fn in ups:
+            os.unlink(fsenc(fn), dir_fd=dfd)
+
+    os.close(dfd)
 
     wh_ok(yi, md)
 